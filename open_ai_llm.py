@@ -1,13 +1,24 @@
+import ast
+import asyncio
+import functools
+import hashlib
 import json
+import math
 import os
+import random
 import re
 import logging
+import sqlite3
+import sys
+import time
 from typing import List, Dict, Any
 
-from dotenv import load_dotenv
-from openai import OpenAI
 from pydantic import BaseModel, ValidationError
 
+# openai (and the httpx/anyio stack under it) is imported lazily inside
+# _shared_client: importing it here costs a few hundred ms of cold start that
+# consumers of calculate()/the schemas never need to pay.
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -15,9 +26,44 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
 MODEL_NAME = "gpt-4.1-mini"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Upper bound for a single tool execution; trivial for the dummy lookups but
+# real once the tools are backed by DB/API calls.
+TOOL_TIMEOUT_SECONDS = 10.0
+
+# Flush stdout once per this many streamed deltas: still feels token-live but
+# amortizes the TTY write syscalls.
+FLUSH_EVERY_DELTAS = 8
+
+# Tool-retry backoff: 100 ms doubling per attempt, capped at 2 s.
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+RETRY_JITTER = 0.05
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for retry `attempt` (counted from 1)."""
+    return min(RETRY_BASE_DELAY * 2 ** (attempt - 1) + random.random() * RETRY_JITTER,
+               RETRY_MAX_DELAY)
+
+# orjson is an optional accelerator (2-5x over stdlib json on list/dict
+# payloads such as embedding vectors); everything works without it. Keys are
+# always sorted so serialized forms -- and digests derived from them, like the
+# tool-schema cache tag -- stay deterministic across runs.
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode()
+
+    _json_loads = json.loads
 
 
 class ProductPriceArgs(BaseModel):
@@ -34,43 +80,97 @@ class CalculateArgs(BaseModel):
     expression: str
     reason: str | None = None
 
-def get_product_price(product_name: str):
-    # Dummy product catalog
-    products = {
-        "Redmi Note 10S 8GB/128GB": 1700,
-        "iPhone 15": 1200,
-        "Samsung S24": 1100,
-        "MacBook Air": 1500,
-        "AirPods Pro": 250,
-        "Watch": None
-    }
-
-    price = products.get(product_name, None)
+# Dummy catalogs, built once at import instead of per call. The casefolded
+# alias tables let lookups like "redmi note 10s 8gb/128gb" or "tsla" hit
+# without per-call normalization of the whole keyspace.
+_PRODUCTS: Dict[str, int | None] = {
+    "Redmi Note 10S 8GB/128GB": 1700,
+    "iPhone 15": 1200,
+    "Samsung S24": 1100,
+    "MacBook Air": 1500,
+    "AirPods Pro": 250,
+    "Watch": None
+}
+_PRODUCTS_CASEFOLD = {name.casefold(): name for name in _PRODUCTS}
+
+_STOCKS: Dict[str, float] = {
+    "AAPL": 185.30,
+    "GOOGL": 138.50,
+    "MSFT": 402.20,
+    "TSLA": 210.10
+}
+_STOCKS_CASEFOLD = {ticker.casefold(): ticker for ticker in _STOCKS}
+
+
+# The lookups are deterministic, so repeats are memoized: a hit skips the
+# alias resolution and message formatting entirely. The cached helpers are
+# sync -- lru_cache on a coroutine function would cache a one-shot coroutine
+# object. For live data sources, swap in a TTL cache instead.
+
+@functools.lru_cache(maxsize=256)
+def _product_price_message(product_name: str) -> str:
+    if product_name not in _PRODUCTS:
+        product_name = _PRODUCTS_CASEFOLD.get(product_name.casefold(), product_name)
+
+    price = _PRODUCTS.get(product_name)
 
     if price is None:
-        logger.warning(f"Price for '{product_name}' not found.")
+        logger.warning("Price for '%s' not found.", product_name)
         return f"Price for '{product_name}' not found."
-    
+
     return f"The price of {product_name} is ${price}."
 
-def get_stock_price(ticker: str):
-    # Dummy stock database
-    stocks = {
-        "AAPL": 185.30,
-        "GOOGL": 138.50,
-        "MSFT": 402.20,
-        "TSLA": 210.10
-    }
+@functools.lru_cache(maxsize=256)
+def _stock_price_message(ticker: str) -> str:
+    if ticker not in _STOCKS:
+        ticker = _STOCKS_CASEFOLD.get(ticker.casefold(), ticker)
 
-    price = stocks.get(ticker, None)
+    price = _STOCKS.get(ticker)
 
     if price is None:
-        logger.warning(f"Stock price for '{ticker}' not found.")
+        logger.warning("Stock price for '%s' not found.", ticker)
         return f"Stock price for '{ticker}' not found."
 
     return f"The current stock price of {ticker} is ${price}."
 
+async def get_product_price(product_name: str):
+    return _product_price_message(product_name)
+
+async def get_stock_price(ticker: str):
+    return _stock_price_message(ticker)
+
 
+def _tool_output_failed(output: str) -> bool:
+    """Matches the error and not-found strings the tools emit on failure."""
+    return output.startswith("Error") or output.endswith("not found.")
+
+
+# Compiled once at import so calculate() skips the re-cache lookup per call.
+# e.g. '69% * 69' -> '(69/100)*69'
+_PCT_MUL = re.compile(r"\s*(\d+)\s*%\s*\*\s*(\d+)\s*")
+
+# Allowed characters after normalization; set membership beats regex setup
+# for a plain character-class check.
+_SAFE_CHARS = frozenset("0123456789+-*/(). %")
+
+# AST nodes a normalized expression may contain: literals and arithmetic only.
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.USub, ast.UAdd,
+)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_expr(expr: str):
+    """Parse, whitelist-check and compile an expression once per unique string."""
+    tree = ast.parse(expr, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError("Expression contains unsupported syntax.")
+    return compile(tree, "<calc>", "eval")
+
+
+@functools.lru_cache(maxsize=256)
 def calculate(expression: str) -> float:
     """Safely evaluate a basic math expression."""
     # Simple normalization
@@ -80,17 +180,23 @@ def calculate(expression: str) -> float:
     normalized = normalized.replace("% of", "/100 *")
 
     # Handle 'a% * b' or 'a%  b' -> '(a/100)*b'
-    # e.g. '69% * 69' -> '(69/100)*69'
-    match = re.fullmatch(r"\s*(\d+)\s*%\s*\*\s*(\d+)\s*", normalized)
+    match = _PCT_MUL.fullmatch(normalized)
     if match:
         a, b = match.groups()
         normalized = f"({a}/100)*{b}"
 
     # Allow only safe characters
-    if not re.fullmatch(r"[0-9+\-*/(). %]+", normalized):
+    if not normalized or not _SAFE_CHARS.issuperset(normalized):
         raise ValueError("Expression contains unsupported characters.")
 
-    return eval(normalized, {"__builtins__": {}}, {})
+    # Compilation (parse + whitelist walk) is cached per unique expression,
+    # so repeated queries only pay the bytecode eval.
+    return eval(_compile_expr(normalized), {"__builtins__": {}}, {})
+
+
+async def _calculate_tool(expression: str) -> str:
+    """Tool-facing wrapper so calculate() returns a string like the other tools."""
+    return f"Result of '{expression}' is {calculate(expression)}."
 
 # Tool Schemas (The "Menu" for the LLM)
 AVAILABLE_TOOLS = [
@@ -153,119 +259,316 @@ AVAILABLE_TOOLS = [
     },
 ]
 
+# O(1) dispatch: tool name -> (implementation, argument schema). Replaces an
+# if/elif ladder of string compares in _execute_tool.
+_TOOLS = {
+    "get_product_price": (get_product_price, ProductPriceArgs),
+    "get_stock_price": (get_stock_price, StockPriceArgs),
+    "calculate": (_calculate_tool, CalculateArgs),
+}
+
+# Serialized once at import: the tool schema is static, so re-walking the
+# nested dicts per call is pure waste. The digest doubles as a cache tag --
+# any schema change automatically invalidates stale semantic-cache entries.
+_TOOLS_JSON = _json_dumps(AVAILABLE_TOOLS)
+_TOOLS_TAG = hashlib.sha1(_TOOLS_JSON).hexdigest()[:8]
+
+
+class SemanticCache:
+    """Embedding-based response cache for paraphrased queries.
+
+    Near-duplicate queries ("price of TSLA stock?" vs "what's TSLA's stock
+    price") resolve via a local cosine-similarity lookup instead of paying the
+    LLM round trips again. Entries are persisted to SQLite and invalidated by
+    `ttl` or by bumping `tag`.
+    """
+
+    def __init__(self, client, db_path: str = "semantic_cache.db",
+                 threshold: float = 0.92, ttl: float = 3600.0, tag: str = "v1"):
+        self.client = client
+        self.threshold = threshold
+        self.ttl = ttl
+        self.tag = tag
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(query TEXT, vector TEXT, response TEXT, tag TEXT, created REAL)"
+        )
+        self._conn.commit()
+
+    async def _embed(self, text: str) -> List[float]:
+        response = await self.client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        vector = response.data[0].embedding
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    async def get(self, query: str) -> tuple[str | None, List[float]]:
+        """Top-1 lookup. Returns (cached response or None, query vector).
+
+        The vector is returned so a later put() does not pay a second
+        embedding call for the same query.
+        """
+        vector = await self._embed(query)
+        cutoff = time.time() - self.ttl
+        rows = self._conn.execute(
+            "SELECT vector, response FROM cache WHERE tag = ? AND created >= ?",
+            (self.tag, cutoff),
+        ).fetchall()
+
+        best_score, best_response = 0.0, None
+        for stored_vector, response in rows:
+            # Vectors are normalized, so the dot product is cosine similarity.
+            score = sum(a * b for a, b in zip(vector, _json_loads(stored_vector)))
+            if score > best_score:
+                best_score, best_response = score, response
+
+        if best_response is not None and best_score >= self.threshold:
+            logger.info("Semantic cache hit (similarity %.3f).", best_score)
+            return best_response, vector
+        return None, vector
+
+    def put(self, query: str, vector: List[float], response: str) -> None:
+        self._conn.execute(
+            "INSERT INTO cache VALUES (?, ?, ?, ?, ?)",
+            (query, _json_dumps(vector), response, self.tag, time.time()),
+        )
+        self._conn.commit()
+
+
+# One client -- and thus one TCP/TLS connection pool -- shared by every agent
+# instance. HTTP/2 multiplexes the concurrent demo queries over a single
+# connection instead of paying a TLS handshake per agent.
+_CLIENT = None
+
+
+def _shared_client(api_key: str):
+    global _CLIENT
+    if _CLIENT is None:
+        import httpx
+        from openai import AsyncOpenAI
+
+        _CLIENT = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                http2=True,
+            ),
+        )
+    return _CLIENT
+
+
+# Heuristic for the synthesis fast path: pure retrieval phrasing that the
+# templated tool outputs already answer, vs phrasing that wants the model to
+# reason over the results.
+_RETRIEVAL_KEYWORDS = ("price", "stock", "calculate", "how much")
+_SYNTHESIS_KEYWORDS = ("explain", "compare", "why", "summarize", "difference")
+
+
 class PriceAgent:
-    def __init__(self , max_retries: int = 2):
+    def __init__(self , max_retries: int = 2, use_server_history: bool = True):
         self.api_key = os.environ.get("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY not found in environment variables.")
-        
-        self.client = OpenAI(api_key=self.api_key)
+
+        self.client = _shared_client(self.api_key)
         self.history: List[Dict[str, Any]] = []
         self.max_retries = max_retries
+        # Chain the synthesis call to the first response server-side so only
+        # the new tool outputs are uploaded. Disable if local history edits
+        # between the two calls ever become necessary.
+        self.use_server_history = use_server_history
+        self.cache = SemanticCache(self.client, tag=f"v1-{_TOOLS_TAG}")
 
-    def _execute_tool(self, tool_call: Any) -> str:
+    async def _execute_tool(self, tool_call: Any) -> str:
         """Parses the LLM request and executes one of the Python tools with validation and retry."""
         retries = 0
         while retries <= self.max_retries:
             try:
                 function_name = tool_call.name
-                raw_arguments = json.loads(tool_call.arguments or "{}")
-
-                logger.info(f"Tool requested: {function_name} with raw args: {raw_arguments}")
-
-                if function_name == "get_product_price":
-                    args = ProductPriceArgs(**raw_arguments)
-                    if args.reason:
-                        logger.info(f"Model's reason for using get_product_price: {args.reason}")
-                    result = get_product_price(product_name=args.product_name)
-
-                elif function_name == "get_stock_price":
-                    args = StockPriceArgs(**raw_arguments)
-                    if args.reason:
-                        logger.info(f"Model's reason for using get_stock_price: {args.reason}")
-                    result = get_stock_price(ticker=args.ticker)
-
-                elif function_name == "calculate":
-                    args = CalculateArgs(**raw_arguments)
-                    if args.reason:
-                        logger.info(f"Model's reason for using calculate: {args.reason}")
-                    calc_result = calculate(expression=args.expression)
-                    result = f"Result of '{args.expression}' is {calc_result}."
-
-                else:
-                    logger.warning(f"Error: Tool {function_name} not found.")
+                logger.info("Tool requested: %s with raw args: %s", function_name, tool_call.arguments)
+
+                entry = _TOOLS.get(function_name)
+                if entry is None:
+                    logger.warning("Error: Tool %s not found.", function_name)
                     return f"Error: Tool {function_name} not found."
+                tool_fn, schema = entry
+
+                # pydantic-core parses the JSON directly in Rust -- one pass,
+                # no intermediate dict -- instead of json.loads + validator.
+                args = schema.model_validate_json(tool_call.arguments or "{}")
+                if args.reason:
+                    logger.info("Model's reason for using %s: %s", function_name, args.reason)
 
-                logger.info(f"Tool {function_name} executed successfully with result: {result}")
+                async with asyncio.timeout(TOOL_TIMEOUT_SECONDS):
+                    result = await tool_fn(**args.model_dump(exclude={"reason"}))
+
+                logger.info("Tool %s executed successfully with result: %s", function_name, result)
                 return result
 
             except ValidationError as ve:
                 retries += 1
                 logger.warning(
-                    f"Argument validation failed for '{tool_call.name}', "
-                    f"attempt {retries}/{self.max_retries}: {ve}"
+                    "Argument validation failed for '%s', attempt %d/%d: %s",
+                    tool_call.name, retries, self.max_retries, ve
                 )
                 if retries > self.max_retries:
                     return f"Error: Invalid arguments for {tool_call.name}."
+                await asyncio.sleep(_backoff_delay(retries))
 
             except Exception as e:
                 retries += 1
                 logger.warning(
-                    f"Error executing tool '{tool_call.name}', "
-                    f"attempt {retries}/{self.max_retries}: {e}"
+                    "Error executing tool '%s', attempt %d/%d: %s",
+                    tool_call.name, retries, self.max_retries, e
                 )
                 if retries > self.max_retries:
                     return f"Error: Failed to execute {tool_call.name} after {self.max_retries} retries."
-
-    def run(self, user_query: str):
+                await asyncio.sleep(_backoff_delay(retries))
+
+    @staticmethod
+    def _is_simple_retrieval(user_query: str) -> bool:
+        """True when the templated tool outputs already answer the query."""
+        lowered = user_query.lower()
+        return (any(k in lowered for k in _RETRIEVAL_KEYWORDS)
+                and not any(k in lowered for k in _SYNTHESIS_KEYWORDS))
+
+    async def _render_stream(self, stream) -> str:
+        """Renders output_text deltas as they arrive and returns the full text."""
+        chunks: List[str] = []
+        pending = 0
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                sys.stdout.write(event.delta)
+                chunks.append(event.delta)
+                pending += 1
+                if pending >= FLUSH_EVERY_DELTAS:
+                    sys.stdout.flush()
+                    pending = 0
+        sys.stdout.flush()
+        return "".join(chunks)
+
+    async def run(self, user_query: str):
         """Main orchestration loop."""
-        
+
+        # 0. Semantic cache: a paraphrased repeat skips both LLM calls.
+        # The turn is still recorded locally -- the cached answer stands in
+        # for the assistant turn -- so a reused agent's next (miss) query
+        # uploads a coherent transcript.
+        cached, query_vector = await self.cache.get(user_query)
+        if cached is not None:
+            self.history.append({"role": "user", "content": user_query})
+            self.history.append({"role": "assistant", "content": cached})
+            print("\n--- FINAL RESPONSE (cached) ---")
+            print(cached)
+            print("----------------------\n")
+            return
+
         # 1. Initialize conversation
         self.history.append({"role": "user", "content": user_query})
-        logger.info(f"User Query: {user_query}")
+        logger.info("User Query: %s", user_query)
 
-        # 2. First Call: Reasoning & Tool Selection
-        response = self.client.responses.create(
+        # 2. First Call (streamed): Reasoning & Tool Selection
+        # If the model answers directly (no tools), the text renders live here.
+        print("\n--- FINAL RESPONSE ---")
+        async with self.client.responses.stream(
             model=MODEL_NAME,
             tools=AVAILABLE_TOOLS,
             input=self.history,
-        )
+            # Ask for all needed tool calls in this one turn rather than
+            # chaining them across extra roundtrips; the TaskGroup below
+            # runs whatever comes back concurrently.
+            parallel_tool_calls=True,
+        ) as stream:
+            final_text = await self._render_stream(stream)
+            response = await stream.get_final_response()
 
         # Update history with the model's initial thought process
-        self.history += response.output
+        self.history.extend(response.output)
 
         # 3. Check for Tool Calls
-        for item in response.output:
-            if item.type == "function_call":
-                
-                logger.info(f"Model requested tool: {item.name}")
-                
-                # Execute Logic
-                tool_result = self._execute_tool(item)
-                
-                # Feed result back to the model
-                self.history.append({
+        # Independent tool executions run concurrently: N tool latencies
+        # collapse to max(N) instead of sum(N) once the tools do real I/O.
+        tool_calls = [item for item in response.output if item.type == "function_call"]
+        if tool_calls:
+            async with asyncio.TaskGroup() as tg:
+                tasks = [tg.create_task(self._execute_tool(item)) for item in tool_calls]
+
+            # Feed results back to the model in one batch, preserving
+            # call_id order
+            tool_outputs = [
+                {
                     "type": "function_call_output",
                     "call_id": item.call_id,
-                    "output" : tool_result
-                })
-
-        # 4. Second Call: Final Synthesis
-        # We instruct the model to just give the answer now that it has the data
-        final_response = self.client.responses.create(
+                    "output" : task.result()
+                }
+                for item, task in zip(tool_calls, tasks)
+            ]
+            self.history.extend(tool_outputs)
+        else:
+            # The first stream already rendered the full answer.
+            print("\n----------------------\n")
+            self.cache.put(user_query, query_vector, final_text)
+            return
+
+        # 3b. Fast path: the tool outputs are already natural-language
+        # sentences, so a plain retrieval query needs no synthesis turn at
+        # all -- one LLM roundtrip instead of two. Any failed tool (error or
+        # not-found) falls through to synthesis and is never cached verbatim.
+        outputs = [entry["output"] for entry in tool_outputs]
+        if self._is_simple_retrieval(user_query) and not any(_tool_output_failed(o) for o in outputs):
+            answer = "\n".join(outputs)
+            print(answer)
+            print("----------------------\n")
+            self.cache.put(user_query, query_vector, final_text + answer)
+            return
+
+        # 4. Second Call (streamed): Final Synthesis
+        # Tokens are rendered as they arrive instead of after full completion,
+        # so the synthesis begins right after the tool outputs are appended.
+        # With server-side chaining the API already holds the first turn, so
+        # only the new tool outputs travel over the wire instead of the whole
+        # transcript.
+        if self.use_server_history:
+            synthesis_input, previous_id = tool_outputs, response.id
+        else:
+            synthesis_input, previous_id = self.history, None
+
+        async with self.client.responses.stream(
             model=MODEL_NAME,
             instructions="Respond naturally using the tool outputs provided.",
             tools=AVAILABLE_TOOLS,
-            input=self.history,
-        )
+            input=synthesis_input,
+            previous_response_id=previous_id,
+        ) as stream:
+            final_text += await self._render_stream(stream)
+        print("\n----------------------\n")
 
-        # 5. Extract and display final text
-        print("\n--- FINAL RESPONSE ---")
-        print(final_response.output_text)
-        print("----------------------\n")
+        self.cache.put(user_query, query_vector, final_text)
+
+# Cap on in-flight queries so the demo stays under OpenAI rate limits.
+MAX_CONCURRENT_QUERIES = 3
+
+
+async def main():
+    queries = [
+        "what is the price of Redmi Note 10S 8GB/128GB?",
+        "what is the stock price of TSLA?",
+        "Calculate 69% of 69?",
+    ]
+
+    # One agent per query: the queries are independent and histories must
+    # not interleave, so total wall time is max(queries), not sum(queries).
+    agents = [PriceAgent() for _ in queries]
+    limiter = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+
+    async def run_limited(agent: PriceAgent, query: str):
+        async with limiter:
+            await agent.run(query)
+
+    await asyncio.gather(*(run_limited(a, q) for a, q in zip(agents, queries)))
 
 if __name__ == "__main__":
-    agent = PriceAgent()
-    agent.run("what is the price of Redmi Note 10S 8GB/128GB?")
-    agent.run("what is the stock price of TSLA?")
-    agent.run("Calculate 69% of 69?")
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    asyncio.run(main())